@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""Estimate bus arrival times from historical stop-event data.
+
+The input CSV is expected to contain one row per observed stop event with
+the columns: trip_id, direction, bus_stop, date, arrival_time,
+departure_time, dwell_time_in_seconds.
+"""
+
+import argparse
+import os
+import sys
+import zipfile
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+
+def load_and_preprocess_csv(csv_path):
+    """Read the stop-event CSV and normalise types.
+
+    Returns a dataframe sorted by (trip_id, arrival_time) with proper
+    datetime columns for arrival and departure.
+
+    A parquet sidecar is kept next to the CSV so repeated invocations
+    skip the CSV parse and type conversions entirely.
+    """
+    parquet_path = csv_path + '.parquet'
+    try:
+        if os.path.getmtime(parquet_path) >= os.path.getmtime(csv_path):
+            return pd.read_parquet(parquet_path)
+    except (OSError, ImportError, ValueError):
+        pass  # absent, unreadable or corrupt cache; reparse the CSV
+
+    # Typed read: the C parser produces the categorical key columns
+    # (integer codes instead of hashed Python strings), the float32
+    # dwell column and the parsed date directly, with no second
+    # object->typed conversion pass over the frame.
+    try:
+        df = pd.read_csv(
+            csv_path,
+            dtype={'trip_id': 'category', 'bus_stop': 'category',
+                   'direction': 'category',
+                   'dwell_time_in_seconds': 'float32'},
+            parse_dates=['date'])
+    except FileNotFoundError:
+        sys.exit(f"error: no such file: {csv_path}")
+
+    # Adding a parsed timedelta to the date avoids formatting every row
+    # back to a string and re-parsing the concatenation.
+    df['arrival_time'] = df['date'] + pd.to_timedelta(df['arrival_time'])
+    df['departure_time'] = df['date'] + pd.to_timedelta(df['departure_time'])
+
+    df = df.sort_values(['trip_id', 'arrival_time'], kind='stable')
+    df = df.reset_index(drop=True)
+
+    # Write-then-rename so an interrupted run can't leave a truncated
+    # sidecar behind.
+    try:
+        df.to_parquet(parquet_path + '.tmp', engine='pyarrow')
+        os.replace(parquet_path + '.tmp', parquet_path)
+    except (ImportError, OSError):
+        pass  # no pyarrow or read-only directory; just skip the cache
+    return df
+
+
+def build_trip_index(df):
+    """Map trip_id -> (start, stop) row positions in the sorted frame.
+
+    The frame is sorted by trip_id, so every trip occupies one
+    contiguous block of rows; slicing by position replaces a full-column
+    equality scan per lookup.
+    """
+    if df.empty:
+        return {}
+    codes = df['trip_id'].cat.codes.to_numpy()
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    categories = df['trip_id'].cat.categories
+    # Code -1 is a missing trip_id; indexing categories with it would
+    # steal the last real trip's label, so skip that block.
+    return {categories[codes[start]]: (start, stop)
+            for start, stop in zip(starts, ends) if codes[start] >= 0}
+
+
+def print_prediction(trip_id, stop, direction, stats, hourly, daily):
+    """Print the travel-time prediction for one stop, adjusted for the
+    current time of day."""
+    prediction = stats['mean']
+    now = datetime.now()
+    factor = hourly[now.hour]
+    if not np.isnan(factor):
+        prediction *= factor
+    factor = daily[now.weekday()]
+    if not np.isnan(factor):
+        prediction *= factor
+    print(f"trip {trip_id} at stop {stop} (direction {direction}):")
+    print(f"  estimated travel time: {prediction / 60:.1f} min "
+          f"(+/- {stats['std'] / 60:.1f} min, n={int(stats['count'])})")
+    print(f"  mean dwell time: {stats['dwell']:.1f} s")
+
+
+def estimate_for_group(group):
+    """Stats and hour/weekday factors for one (direction, bus_stop) group.
+
+    Returns (stats, hourly, daily) where stats is a dict with
+    mean/std/count/dwell and hourly/daily are the dense factor arrays of
+    length 24 and 7.
+    """
+    travel = group['travel_time']
+    mean = travel.mean()
+    stats = {'mean': mean, 'std': travel.std(), 'count': travel.count(),
+             'dwell': group['dwell_time_in_seconds'].mean()}
+    hourly = np.full(24, np.nan, dtype=np.float32)
+    hourly_mean = travel.groupby(group['hour']).mean()
+    hourly[hourly_mean.index.to_numpy()] = hourly_mean.to_numpy() / mean
+    daily = np.full(7, np.nan, dtype=np.float32)
+    daily_mean = travel.groupby(group['day_of_week']).mean()
+    daily[daily_mean.index.to_numpy()] = daily_mean.to_numpy() / mean
+    return stats, hourly, daily
+
+
+def estimate_arrival_time(df, target_trip_id=None, target_stop=None,
+                          trip_index=None):
+    """Compute travel-time statistics per (direction, bus_stop).
+
+    Returns a tuple (base, hourly_factors, daily_factors):
+
+    * base -- dataframe indexed by (direction, bus_stop) with columns
+      mean/std/count of travel time in seconds plus mean dwell time,
+    * hourly_factors -- float32 array of shape (len(base), 24), row i
+      holding hour-of-day ratios of mean travel time to the overall mean
+      for base row i (NaN where the hour was never observed),
+    * daily_factors -- the same as shape (len(base), 7), keyed by day of
+      week.
+
+    When both target_trip_id and target_stop are given, only the one
+    needed group is aggregated: the trip's direction is resolved via the
+    trip slice index, estimate_for_group runs on that single subset, a
+    prediction based on the current time of day is printed and None is
+    returned.
+
+    The derived travel_time/hour/day_of_week columns are attached to df
+    in place.
+    """
+    if trip_index is None:
+        trip_index = build_trip_index(df)
+    if target_trip_id is not None and target_trip_id not in trip_index:
+        sys.exit(f"error: unknown trip_id: {target_trip_id}")
+
+    # load_and_preprocess_csv already sorts by (trip_id, arrival_time);
+    # that ordering is what the row-gap travel-time pass and the trip
+    # slice index rely on.
+
+    # With the frame sorted by (trip_id, arrival_time), the next stop of
+    # a trip is simply the next row, so the groupby shift collapses to a
+    # single pass over the raw arrays: gap to the next row, masked out at
+    # trip boundaries.
+    trip_codes = df['trip_id'].cat.codes.to_numpy()
+    arrival = df['arrival_time'].to_numpy()
+    departure = df['departure_time'].to_numpy()
+    # float32 halves the bytes the memory-bound aggregations read; the
+    # groupby mean/std kernels still accumulate in float64.
+    travel_time = np.full(len(df), np.nan, dtype=np.float32)
+    if len(df) > 1:
+        gap = (arrival[1:] - departure[:-1]) / np.timedelta64(1, 's')
+        # Code -1 is a missing trip_id; consecutive missing rows compare
+        # equal, so require a real code or a gap would be fabricated
+        # between unrelated trips.
+        travel_time[:-1] = np.where(
+            (trip_codes[1:] == trip_codes[:-1]) & (trip_codes[1:] >= 0),
+            gap, np.nan)
+    df['travel_time'] = travel_time
+
+    # Hour and weekday straight from the int64 nanosecond view: one
+    # div+mod each, no .dt accessor Series round-trip. Epoch day zero
+    # (1970-01-01) was a Thursday, i.e. 3 in Monday=0 numbering.
+    ns = df['arrival_time'].to_numpy(dtype='datetime64[ns]').view('i8')
+    df['hour'] = ((ns // 3_600_000_000_000) % 24).astype(np.int8)
+    df['day_of_week'] = (((ns // 86_400_000_000_000) + 3) % 7).astype(np.int8)
+
+    if target_trip_id is not None and target_stop is not None:
+        # Only one (direction, bus_stop) group is needed; skip the
+        # all-groups aggregation entirely.
+        start, stop = trip_index[target_trip_id]
+        direction = df['direction'].iloc[stop - 1]
+        group = df[(df['direction'] == direction)
+                   & (df['bus_stop'] == target_stop)]
+        if group.empty:
+            sys.exit(f"error: no data for stop {target_stop} "
+                     f"on direction {direction}")
+        stats, hourly, daily = estimate_for_group(group)
+        print_prediction(target_trip_id, target_stop, direction,
+                         stats, hourly, daily)
+        return None
+
+    # Pack both categorical codes into one int64 so the groupbys hash a
+    # single integer column instead of traversing two key columns.
+    # Code -1 marks a missing value; those rows must be dropped before
+    # packing, matching groupby's default NaN-key handling, or they
+    # would alias real categories in the packed key.
+    dir_codes = df['direction'].cat.codes.to_numpy().astype(np.int64)
+    stop_codes = df['bus_stop'].cat.codes.to_numpy().astype(np.int64)
+    valid = (dir_codes >= 0) & (stop_codes >= 0)
+    if not valid.all():
+        df = df[valid]
+        dir_codes = dir_codes[valid]
+        stop_codes = stop_codes[valid]
+    key = (dir_codes << 32) | stop_codes
+
+    base = df.groupby(key, sort=False).agg(
+        mean=('travel_time', 'mean'),
+        std=('travel_time', 'std'),
+        count=('travel_time', 'count'),
+        dwell=('dwell_time_in_seconds', 'mean'))
+
+    # Dense per-group factor tables: hour and weekday are tiny fixed
+    # domains, so a (groups, 24) / (groups, 7) array indexes in one load
+    # where a dict per group would box every float.
+    hourly_mean = df.groupby([key, df['hour']], sort=False)['travel_time'].mean()
+    group_pos = base.index.get_indexer(hourly_mean.index.get_level_values(0))
+    hourly_factors = np.full((len(base), 24), np.nan, dtype=np.float32)
+    hourly_factors[group_pos, hourly_mean.index.get_level_values(1)] = (
+        hourly_mean.to_numpy() / base['mean'].to_numpy()[group_pos])
+
+    daily_mean = df.groupby([key, df['day_of_week']], sort=False)['travel_time'].mean()
+    group_pos = base.index.get_indexer(daily_mean.index.get_level_values(0))
+    daily_factors = np.full((len(base), 7), np.nan, dtype=np.float32)
+    daily_factors[group_pos, daily_mean.index.get_level_values(1)] = (
+        daily_mean.to_numpy() / base['mean'].to_numpy()[group_pos])
+
+    # Unpack the int64 keys back into the (direction, bus_stop) index
+    # the callers expect.
+    packed = base.index.to_numpy()
+    base.index = pd.MultiIndex.from_arrays(
+        [df['direction'].cat.categories[packed >> 32],
+         df['bus_stop'].cat.categories[packed & 0xFFFFFFFF]],
+        names=['direction', 'bus_stop'])
+
+    return base, hourly_factors, daily_factors
+
+
+def load_estimates_cache(csv_path):
+    """Load the aggregated estimates from the npz sidecar.
+
+    Returns (base, hourly_factors, daily_factors, trip_directions) or
+    None when the cache is absent or the CSV changed since it was
+    written (checked via mtime and size recorded in the archive).
+    """
+    try:
+        st = os.stat(csv_path)
+        with np.load(csv_path + '.estimates.npz', allow_pickle=False) as npz:
+            if (npz['csv_mtime'] != st.st_mtime
+                    or npz['csv_size'] != st.st_size):
+                return None
+            base = pd.DataFrame(
+                {'mean': npz['mean'], 'std': npz['std'],
+                 'count': npz['count'], 'dwell': npz['dwell']},
+                index=pd.MultiIndex.from_arrays(
+                    [npz['direction'], npz['bus_stop']],
+                    names=['direction', 'bus_stop']))
+            trip_directions = dict(zip(npz['trip_id'], npz['trip_direction']))
+            return base, npz['hourly'], npz['daily'], trip_directions
+    except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+        return None
+
+
+def save_estimates_cache(csv_path, base, hourly_factors, daily_factors,
+                         trip_directions):
+    """Persist the aggregated estimates next to the CSV (best effort)."""
+    st = os.stat(csv_path)
+    # Write-then-rename so an interrupted run can't leave a truncated
+    # archive behind.
+    cache_path = csv_path + '.estimates.npz'
+    # The temp name keeps the .npz suffix so savez doesn't append one.
+    try:
+        np.savez_compressed(
+            cache_path + '.tmp.npz',
+            csv_mtime=st.st_mtime, csv_size=st.st_size,
+            direction=np.asarray(base.index.get_level_values(0), dtype=str),
+            bus_stop=np.asarray(base.index.get_level_values(1), dtype=str),
+            mean=base['mean'].to_numpy(),
+            std=base['std'].to_numpy(),
+            count=base['count'].to_numpy(),
+            dwell=base['dwell'].to_numpy(),
+            hourly=hourly_factors, daily=daily_factors,
+            trip_id=np.asarray(list(trip_directions), dtype=str),
+            trip_direction=np.asarray(list(trip_directions.values()),
+                                      dtype=str))
+        os.replace(cache_path + '.tmp.npz', cache_path)
+    except OSError:
+        pass
+
+
+def _intern(values, table):
+    """Map labels to stable integer codes, extending the table as new
+    labels appear."""
+    for value in pd.unique(values):
+        if value not in table:
+            table[value] = len(table)
+    return values.map(table).to_numpy(dtype=np.int64)
+
+
+def estimate_from_csv_chunked(csv_path, chunksize):
+    """Stream the CSV and aggregate incrementally in bounded memory.
+
+    Produces the same (base, hourly_factors, daily_factors) tuple as
+    estimate_arrival_time without ever holding the full frame: running
+    sum / sum-of-squares / count accumulators per packed
+    (direction, bus_stop) key — and per (key, hour) / (key, weekday) for
+    the factor tables — are updated chunk by chunk and finalized after
+    the stream. Peak memory is proportional to the number of distinct
+    keys, not the file size.
+
+    Rows are processed in file order, so the CSV must already be grouped
+    by trip with stops in time order; the last row of each chunk is
+    carried into the next one so trips spanning a chunk boundary keep
+    their boundary travel time.
+    """
+    directions = {}
+    stops = {}
+    travel_sum = pd.Series(dtype='float64')
+    travel_sumsq = pd.Series(dtype='float64')
+    travel_cnt = pd.Series(dtype='float64')
+    dwell_sum = pd.Series(dtype='float64')
+    dwell_cnt = pd.Series(dtype='float64')
+    hour_sum = pd.Series(dtype='float64')
+    hour_cnt = pd.Series(dtype='float64')
+    day_sum = pd.Series(dtype='float64')
+    day_cnt = pd.Series(dtype='float64')
+
+    tail = None
+    try:
+        reader = pd.read_csv(csv_path, chunksize=chunksize,
+                             dtype={'dwell_time_in_seconds': 'float32'})
+    except FileNotFoundError:
+        sys.exit(f"error: no such file: {csv_path}")
+    for chunk in reader:
+        chunk['date'] = pd.to_datetime(chunk['date'], format='%Y-%m-%d')
+        chunk['arrival_time'] = (chunk['date']
+                                 + pd.to_timedelta(chunk['arrival_time']))
+        chunk['departure_time'] = (chunk['date']
+                                   + pd.to_timedelta(chunk['departure_time']))
+        carried = tail is not None
+        if carried:
+            chunk = pd.concat([tail, chunk], ignore_index=True)
+        tail = chunk.iloc[-1:]
+
+        # Match estimate_arrival_time's NaN-key handling: rows with a
+        # missing direction or bus_stop are never interned and
+        # contribute no observations.
+        keep = (chunk['direction'].notna()
+                & chunk['bus_stop'].notna()).to_numpy()
+        key = np.full(len(chunk), -1, dtype=np.int64)
+        if keep.any():
+            key[keep] = (
+                (_intern(chunk['direction'][keep].astype(str),
+                         directions) << 32)
+                | _intern(chunk['bus_stop'][keep].astype(str), stops))
+        trip = chunk['trip_id'].to_numpy()
+        arrival = chunk['arrival_time'].to_numpy(dtype='datetime64[ns]')
+        departure = chunk['departure_time'].to_numpy(dtype='datetime64[ns]')
+        travel = np.full(len(chunk), np.nan)
+        if len(chunk) > 1:
+            gap = (arrival[1:] - departure[:-1]) / np.timedelta64(1, 's')
+            travel[:-1] = np.where(trip[1:] == trip[:-1], gap, np.nan)
+
+        ns = arrival.view('i8')
+        hour = (ns // 3_600_000_000_000) % 24
+        day = ((ns // 86_400_000_000_000) + 3) % 7
+
+        valid = ~np.isnan(travel) & keep
+        k, t = key[valid], travel[valid]
+        grouped = pd.Series(t).groupby(k)
+        travel_sum = travel_sum.add(grouped.sum(), fill_value=0)
+        travel_sumsq = travel_sumsq.add(
+            pd.Series(t * t).groupby(k).sum(), fill_value=0)
+        travel_cnt = travel_cnt.add(grouped.size(), fill_value=0)
+
+        hkey = (k << 5) | hour[valid]
+        grouped = pd.Series(t).groupby(hkey)
+        hour_sum = hour_sum.add(grouped.sum(), fill_value=0)
+        hour_cnt = hour_cnt.add(grouped.size(), fill_value=0)
+
+        dkey = (k << 3) | day[valid]
+        grouped = pd.Series(t).groupby(dkey)
+        day_sum = day_sum.add(grouped.sum(), fill_value=0)
+        day_cnt = day_cnt.add(grouped.size(), fill_value=0)
+
+        # The carried row's dwell was already counted in its own chunk.
+        offset = 1 if carried else 0
+        dwell = chunk['dwell_time_in_seconds'].to_numpy()[offset:]
+        dvalid = ~np.isnan(dwell) & keep[offset:]
+        grouped = pd.Series(dwell[dvalid]).groupby(key[offset:][dvalid])
+        dwell_sum = dwell_sum.add(grouped.sum(), fill_value=0)
+        dwell_cnt = dwell_cnt.add(grouped.size(), fill_value=0)
+
+    mean = travel_sum / travel_cnt
+    variance = (travel_sumsq - travel_sum ** 2 / travel_cnt) / (travel_cnt - 1)
+    base = pd.DataFrame({
+        'mean': mean,
+        'std': np.sqrt(variance.clip(lower=0)),
+        'count': travel_cnt,
+        'dwell': dwell_sum / dwell_cnt,
+    })
+    mean = base['mean'].to_numpy()
+
+    hourly_mean = hour_sum / hour_cnt
+    hkey = hourly_mean.index.to_numpy()
+    group_pos = base.index.get_indexer(hkey >> 5)
+    hourly_factors = np.full((len(base), 24), np.nan, dtype=np.float32)
+    hourly_factors[group_pos, hkey & 31] = (
+        hourly_mean.to_numpy() / mean[group_pos])
+
+    daily_mean = day_sum / day_cnt
+    dkey = daily_mean.index.to_numpy()
+    group_pos = base.index.get_indexer(dkey >> 3)
+    daily_factors = np.full((len(base), 7), np.nan, dtype=np.float32)
+    daily_factors[group_pos, dkey & 7] = (
+        daily_mean.to_numpy() / mean[group_pos])
+
+    direction_labels = np.array(list(directions), dtype=object)
+    stop_labels = np.array(list(stops), dtype=object)
+    packed = base.index.to_numpy().astype(np.int64)
+    base.index = pd.MultiIndex.from_arrays(
+        [direction_labels[packed >> 32], stop_labels[packed & 0xFFFFFFFF]],
+        names=['direction', 'bus_stop'])
+
+    return base, hourly_factors, daily_factors
+
+
+def show_available_trips(df, trip_index=None):
+    """Print every trip with its first and last observed stop."""
+    if trip_index is None:
+        trip_index = build_trip_index(df)
+    # The frame is sorted by (trip_id, arrival_time), so the first and
+    # last row of each trip's slice are its first and last stop; two
+    # fancy-index takes replace a boolean scan per trip.
+    firsts = df.iloc[[start for start, _ in trip_index.values()]]
+    lasts = df.iloc[[stop - 1 for _, stop in trip_index.values()]]
+    print(f"{'trip_id':<12} {'first stop':<24} {'last stop':<24}")
+    for trip_id, first, last in zip(trip_index,
+                                    firsts.itertuples(),
+                                    lasts.itertuples()):
+        print(f"{trip_id:<12} "
+              f"{first.bus_stop:<10} {first.arrival_time:%H:%M:%S}     "
+              f"{last.bus_stop:<10} {last.arrival_time:%H:%M:%S}")
+
+
+def show_stops_for_trip(df, trip_id, trip_index=None):
+    """Print the ordered stop sequence for one trip."""
+    if trip_index is None:
+        trip_index = build_trip_index(df)
+    if trip_id not in trip_index:
+        sys.exit(f"error: unknown trip_id: {trip_id}")
+    start, stop = trip_index[trip_id]
+    trip_data = df.iloc[start:stop]
+    # Format all rows with the vectorized string kernels and emit a
+    # single block instead of boxing a Series per row via iterrows.
+    lines = (trip_data['bus_stop'].astype(str).str.ljust(10) + ' '
+             + trip_data['arrival_time'].dt.strftime('%Y-%m-%d %H:%M:%S')
+               .str.ljust(20) + ' '
+             + trip_data['dwell_time_in_seconds'].map('{:.1f}'.format))
+    sys.stdout.write(f"{'bus_stop':<10} {'arrival':<20} {'dwell (s)':<10}\n"
+                     + '\n'.join(lines) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Estimate bus travel times from historical stop events.')
+    parser.add_argument('csv', help='path to the stop-event CSV')
+    parser.add_argument('--trip', help='trip id to inspect or predict for')
+    parser.add_argument('--stop', help='bus stop to predict arrival at')
+    parser.add_argument('--list-trips', action='store_true',
+                        help='list available trips and exit')
+    parser.add_argument('--output', default='estimates.tsv',
+                        help='output file for the full estimate table')
+    parser.add_argument('--chunksize', type=int, metavar='N',
+                        help='stream the CSV in chunks of N rows (bounded '
+                             'memory); only the full estimate table is '
+                             'supported')
+    args = parser.parse_args()
+
+    if args.chunksize:
+        if args.trip or args.stop or args.list_trips:
+            sys.exit('error: --chunksize only supports the full '
+                     'estimate table')
+        result = estimate_from_csv_chunked(args.csv, args.chunksize)
+    else:
+        cached = None
+        if not args.list_trips and not (args.trip and not args.stop):
+            cached = load_estimates_cache(args.csv)
+
+        if cached is not None:
+            base, hourly_factors, daily_factors, trip_directions = cached
+            if args.trip and args.stop:
+                if args.trip not in trip_directions:
+                    sys.exit(f"error: unknown trip_id: {args.trip}")
+                direction = trip_directions[args.trip]
+                key = (direction, args.stop)
+                if key not in base.index:
+                    sys.exit(f"error: no data for stop {args.stop} "
+                             f"on direction {direction}")
+                pos = base.index.get_loc(key)
+                print_prediction(args.trip, args.stop, direction,
+                                 base.iloc[pos], hourly_factors[pos],
+                                 daily_factors[pos])
+                return
+            result = base, hourly_factors, daily_factors
+        else:
+            df = load_and_preprocess_csv(args.csv)
+            trip_index = build_trip_index(df)
+
+            if args.list_trips:
+                show_available_trips(df, trip_index)
+                return
+
+            if args.trip and not args.stop:
+                show_stops_for_trip(df, args.trip, trip_index)
+                return
+
+            result = estimate_arrival_time(df, args.trip, args.stop,
+                                           trip_index)
+            if result is not None:
+                trip_directions = {
+                    trip: df['direction'].iloc[stop - 1]
+                    for trip, (start, stop) in trip_index.items()}
+                save_estimates_cache(args.csv, *result, trip_directions)
+
+    if result is not None:
+        estimates, hourly_factors, daily_factors = result
+        out = estimates.dropna(subset=['mean']).reset_index()
+        out = pd.DataFrame({
+            'direction': out['direction'],
+            'bus_stop': out['bus_stop'],
+            'mean_minutes': out['mean'] / 60,
+            'std_minutes': out['std'] / 60,
+            'dwell_seconds': out['dwell'],
+        })
+        out.to_csv(args.output, sep='\t', index=False, float_format='%.2f')
+        print(f"wrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()